@@ -4,12 +4,37 @@ A script that integrates BibTeX parsing with the Gemini API. It reads PDFs
 from a folder, finds their corresponding BibTeX citekey, generates a summary 
 using Gemini, saves the summary with the citekey, and archives the file.
 """
+import asyncio
+import functools
+import hashlib
+import io
+import json
+import mimetypes
+import mmap
 import os
+import random
+import re
 import shutil
 import sys
-import time
+import tempfile
+from datetime import datetime, timedelta, timezone
+import aiofiles
 import bibtexparser
-import google.generativeai as genai
+from aiolimiter import AsyncLimiter
+from bibtexparser.bparser import BibTexParser
+from google import genai
+from google.genai import errors, types
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+try:
+    import liburing  # Optional, Linux only: reads papers in one batch with io_uring
+except ImportError:
+    liburing = None
+
+try:
+    import marisa_trie  # Optional: compact citekey lookup for very large bibliographies
+except ImportError:
+    marisa_trie = None
 
 # --- CONFIGURATION ---
 # 1. Directory and File Paths
@@ -24,6 +49,21 @@ MASTER_PROMPT_FILE = "assets/master_prompt.txt"
 SIUNITX_MANUAL = "assets/siunitx.pdf" 
 
 SUMMARIES_FILE = "paper_summaries.txt"
+# Summaries are written here as they are generated, and moved into
+# SUMMARIES_FILE once complete
+SUMMARIES_IN_PROGRESS_DIR = "summaries_in_progress"
+
+# The citekey lookup built from the BibTeX file is cached here and reused
+# until the BibTeX file changes
+BIBTEX_CACHE_FILE = ".bibcache.json"
+
+# The uploaded copy of the reference manual is remembered here, so it can be
+# reused by later runs instead of being uploaded every time
+ASSETS_CACHE_FILE = ".assets_cache.json"
+
+# The SHA-256 digest and citekey of every summarized paper are recorded here,
+# so the same paper is never summarized twice, even under another filename
+PROCESSED_INDEX_FILE = ".processed.json"
 
 # 2. Gemini API Configuration
 # Option 1 (Recommended): Use an environment variable named "GEMINI_API_KEY".
@@ -34,46 +74,182 @@ SUMMARIES_FILE = "paper_summaries.txt"
 # IMPORTANT: Be careful not to share this file publicly if you paste your key here.
 API_KEY_PLACEHOLDER = "PASTE_YOUR_GEMINI_API_KEY_HERE"
 
-# --- DO NOT EDIT BELOW THIS LINE ---
+# 3. Concurrency
+# Number of papers that are uploaded and summarized at the same time.
+# The work is almost entirely waiting on the network, so a few parallel
+# requests finish a reading list several times faster than one at a time.
+MAX_CONCURRENCY = 4
+# Number of additional papers that may be uploaded ahead of time while all
+# MAX_CONCURRENCY summaries are being generated, so that the next paper is
+# ready as soon as a generation finishes.
+UPLOAD_AHEAD = 2
+
+# 4. Batch Mode
+# Set to True to submit all papers as a single Gemini Batch job instead of
+# one request per paper. Batch jobs cost half as much and are not subject to
+# the per-minute rate limits, but can take up to 24 hours to complete. The
+# script checks on the job every BATCH_POLL_INTERVAL seconds until it is done.
+USE_BATCH_MODE = False
+BATCH_POLL_INTERVAL = 60
 
-# Configure the Gemini API
-api_key = os.getenv("GEMINI_API_KEY")
-if api_key:
-    genai.configure(api_key=api_key)
-    print("-> Configured Gemini API with key from environment variable.")
-elif API_KEY_PLACEHOLDER != "PASTE_YOUR_GEMINI_API_KEY_HERE":
-    genai.configure(api_key=API_KEY_PLACEHOLDER)
-    print("-> Configured Gemini API with key from the script file.")
-else:
-    print("\nERROR: Gemini API key not found.")
-    print("Please do one of the following:")
-    print("  1. Paste your API key into the 'API_KEY_PLACEHOLDER' variable in this script.")
-    print("  2. Set the 'GEMINI_API_KEY' environment variable (recommended).")
-    sys.exit(1)
+# 5. Rate Limits
+# Requests and input tokens per minute allowed by your Gemini API tier.
+# The defaults match the free tier for gemini-2.5-pro; raise them if your
+# quota is higher. Requests rejected for exceeding the quota (HTTP 429)
+# are retried up to MAX_RETRIES times, waiting as long as the API asks.
+REQUESTS_PER_MINUTE = 5
+TOKENS_PER_MINUTE = 250_000
+MAX_RETRIES = 5
+
+# 6. Grouping Papers
+# Number of papers summarized together in a single request. Grouping short
+# papers uses fewer requests of the per-minute quota. Papers are only grouped
+# while the whole request, master prompt included, stays below both
+# MAX_GROUP_TOKENS (within gemini-2.5-pro's 1M-token context window) and
+# TOKENS_PER_MINUTE, since a larger request could never be sent.
+PAPERS_PER_REQUEST = 1
+MAX_GROUP_TOKENS = 800_000
+
+# --- DO NOT EDIT BELOW THIS LINE ---
 
 # We will use 'gemini-2.5-pro' as it's excellent for multi-modal tasks.
 MODEL = 'gemini-2.5-pro'
+# Generous timeout (in milliseconds) for long papers.
+GENERATION_CONFIG = types.GenerateContentConfig(http_options=types.HttpOptions(timeout=600_000))
+# How long the cached master prompt is kept by the service. While papers are
+# still being processed the TTL is extended every PROMPT_CACHE_REFRESH_INTERVAL
+# seconds; at the end of the run the cache is deleted. The TTL therefore only
+# bounds how long an orphaned cache is billed if the script crashes.
+PROMPT_CACHE_TTL = '3600s'
+PROMPT_CACHE_REFRESH_INTERVAL = 900
+# Added to the prompt when several papers are summarized in one request
+GROUP_INSTRUCTIONS = (
+    "The following {count} papers must each be summarized separately, exactly as "
+    "instructed above. Each paper is preceded by its filename. Return one entry per "
+    "paper with its filename and its complete summary."
+)
+GROUP_RESPONSE_SCHEMA = types.Schema(
+    type='ARRAY',
+    items=types.Schema(
+        type='OBJECT',
+        properties={'filename': types.Schema(type='STRING'), 'summary': types.Schema(type='STRING')},
+        required=['filename', 'summary'],
+    ),
+)
+# How long (in seconds) to wait at the end of a run for uploaded files that
+# are still being deleted. Files left behind expire after 48 hours.
+DELETE_WAIT_TIMEOUT = 30
+# Batch job states after which the job will not change anymore.
+BATCH_FINAL_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_PARTIALLY_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+# Extra random wait (in seconds) added to a server-suggested retry delay, so
+# that papers rejected at the same time do not all retry at the same time.
+RETRY_JITTER = 5
+
+# Bibliographies with at least this many linked files are looked up through a
+# marisa-trie (if installed), which stores the shared filename prefixes once.
+# Smaller ones stay in a plain dict, which is faster at that size.
+CITEKEY_TRIE_THRESHOLD = 10_000
+
+# Bump whenever the citekey lookup logic changes, so stale caches are rebuilt.
+BIBTEX_CACHE_VERSION = 4
+
+# Uploaded files expire after 48 hours. A cached reference manual is only
+# reused while it has at least this long left, enough for a batch job.
+REFERENCE_MIN_LIFETIME = timedelta(hours=24)
+
+# Shared budgets for all concurrent requests
+request_limiter = AsyncLimiter(REQUESTS_PER_MINUTE, 60)
+token_limiter = AsyncLimiter(TOKENS_PER_MINUTE, 60)
+
+# Deletions of uploaded files still running in the background
+_background_deletes = set()
+
+# The Gemini client, created by _configure_api() when the pipeline starts
+client = None
 # --- END OF CONFIGURATION ---
 
 
+def _configure_api():
+    """
+    Creates the Gemini client from the configured API key, or exits with
+    instructions if there is none. This runs from main() rather than at
+    import, so the helpers in this module can be imported without a key.
+    """
+    global client
+    api_key = os.getenv("GEMINI_API_KEY")
+    if api_key:
+        client = genai.Client(api_key=api_key)
+        print("-> Configured Gemini API with key from environment variable.")
+    elif API_KEY_PLACEHOLDER != "PASTE_YOUR_GEMINI_API_KEY_HERE":
+        client = genai.Client(api_key=API_KEY_PLACEHOLDER)
+        print("-> Configured Gemini API with key from the script file.")
+    else:
+        print("\nERROR: Gemini API key not found.")
+        print("Please do one of the following:")
+        print("  1. Paste your API key into the 'API_KEY_PLACEHOLDER' variable in this script.")
+        print("  2. Set the 'GEMINI_API_KEY' environment variable (recommended).")
+        sys.exit(1)
+
+
+# A PDF or HTML path inside a 'file' field, whose parts are separated by ';' and ':'
+_FILE_PATH_RE = re.compile(r'([^;:]+?\.(?:pdf|html))(?=:|;|$)', re.IGNORECASE)
+
 def parse_file_path_from_entry(file_field_string):
     """
-    Parses the file path from a Zotero/Mendeley-style 'file' field.
-    Example format: ':path/to/my/file.pdf:PDF'
+    Parses the filename from a Zotero/Mendeley-style 'file' field.
+    Example format: ':path/to/my/file.pdf:PDF' gives 'file.pdf'
     """
     if not file_field_string:
         return None
-    parts = file_field_string.split(';')
-    for part in parts:
-        # Check for PDF or HTML files, case-insensitively
-        if '.pdf' in part.lower() or '.html' in part.lower():
-            path_segments = part.split(':')
-            # Iterate backwards to find the last segment that is a file
-            for segment in reversed(path_segments):
-                if segment.lower().endswith(('.pdf', '.html')):
-                    return segment
+    for part in file_field_string.split(';'):
+        # The last matching segment is the path; an earlier one may be a description
+        matches = _FILE_PATH_RE.findall(part)
+        if matches:
+            return os.path.basename(matches[-1])
     return None
 
+# The name of a paper to summarize in the reading folder
+_PAPER_FILENAME_RE = re.compile(r'\.(?:pdf|html)$', re.IGNORECASE)
+
+# The start of each raw BibTeX entry, and a 'file' field inside one
+_ENTRY_TOKEN_RE = re.compile(r'[{}]|^[ \t]*@', re.MULTILINE)
+_FILE_FIELD_RE = re.compile(r'\bfile\s*=', re.IGNORECASE)
+
+def split_bibtex_entries(bibtex_str):
+    """
+    Splits a BibTeX string into raw entries at each '@' that starts a line
+    outside of any braces, so an '@' line inside a braced value (e.g. an
+    abstract or note) does not cut its entry in two.
+    """
+    entries = []
+    start = 0
+    depth = 0
+    for match in _ENTRY_TOKEN_RE.finditer(bibtex_str):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth = max(depth - 1, 0)
+        elif depth == 0 and match.start() > start:
+            entries.append(bibtex_str[start:match.start()])
+            start = match.start()
+    entries.append(bibtex_str[start:])
+    return entries
+
+def parse_bibtex_file(bib_path):
+    """
+    Parses only the BibTeX entries that have a 'file' field, since no other
+    entry can be matched to a PDF. String interpolation and field
+    customization are switched off, as only 'ID' and 'file' are used.
+    """
+    with open(bib_path, 'r', encoding='utf-8') as bibfile:
+        raw_entries = split_bibtex_entries(bibfile.read())
+    bibtex_str = ''.join(entry for entry in raw_entries if _FILE_FIELD_RE.search(entry))
+
+    parser = BibTexParser(common_strings=False, interpolate_strings=False, ignore_nonstandard_types=True)
+    parser.customization = None
+    return bibtexparser.loads(bibtex_str, parser=parser)
+
 def create_pdf_to_citekey_map(bib_database):
     """
     Creates a dictionary mapping PDF filenames to their BibTeX citekeys.
@@ -81,42 +257,726 @@ def create_pdf_to_citekey_map(bib_database):
     Returns:
         dict: A mapping like {'hayes2002.pdf': 'hayes2002distributed'}
     """
-    mapping = {}
-    for entry in bib_database.entries:
-        citekey = entry.get('ID')
-        file_field = entry.get('file')
-        
-        if not citekey or not file_field:
-            continue
-            
-        pdf_path = parse_file_path_from_entry(file_field)
-        if pdf_path:
-            # Extract just the filename from the full path
-            pdf_filename = os.path.basename(pdf_path)
-            mapping[pdf_filename] = citekey
-    
+    mapping = {
+        pdf_filename: entry['ID']
+        for entry in bib_database.entries
+        if entry.get('ID') and (pdf_filename := parse_file_path_from_entry(entry.get('file')))
+    }
+
     if not mapping:
         print("  - WARNING: No valid 'file' entries found in the BibTeX file. The script may not find citekeys.")
-        
+
     return mapping
 
+def load_pdf_to_citekey_map(bib_path):
+    """
+    Returns the PDF filename to citekey lookup for a BibTeX file, see
+    build_citekey_index.
+
+    The mapping is cached in BIBTEX_CACHE_FILE together with the BibTeX
+    file's modification time and size, so the file is only parsed again
+    once it has changed. Within one process the built lookup is also kept
+    in memory, so the plain mapping is not held next to a trie.
+    """
+    stat = os.stat(bib_path)
+    return _load_pdf_to_citekey_map(os.path.abspath(bib_path), stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=4)
+def _load_pdf_to_citekey_map(bib_path, mtime_ns, size):
+    """Loads the mapping for one version of a BibTeX file, see load_pdf_to_citekey_map."""
+    cache_key = [BIBTEX_CACHE_VERSION, bib_path, mtime_ns, size]
+    try:
+        with open(BIBTEX_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if cache.get('key') == cache_key:
+            print(f"-> Loaded citekeys for '{bib_path}' from cache.")
+            return build_citekey_index(cache['mapping'])
+    except (OSError, ValueError, AttributeError):
+        pass  # Missing or unreadable cache, parse the BibTeX file instead
+
+    bib_database = parse_bibtex_file(bib_path)
+    mapping = create_pdf_to_citekey_map(bib_database)
+
+    try:
+        with open(BIBTEX_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({'key': cache_key, 'mapping': mapping}, f)
+    except OSError as e:
+        print(f"  - WARNING: Could not write citekey cache '{BIBTEX_CACHE_FILE}'. Details: {e}")
+    return build_citekey_index(mapping)
+
+def load_master_prompt():
+    """Returns the master prompt, reading the file only when it has changed."""
+    return _load_master_prompt(os.path.abspath(MASTER_PROMPT_FILE), os.stat(MASTER_PROMPT_FILE).st_mtime_ns)
+
+@functools.lru_cache(maxsize=1)
+def _load_master_prompt(prompt_path, mtime_ns):
+    """Reads one version of the master prompt file, see load_master_prompt."""
+    with open(prompt_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
 def setup_directories():
     """Ensures that the necessary directories exist."""
     os.makedirs(PAPERS_TO_READ_DIR, exist_ok=True)
     os.makedirs(READ_PAPERS_DIR, exist_ok=True)
+    os.makedirs(SUMMARIES_IN_PROGRESS_DIR, exist_ok=True)
     os.makedirs("assets", exist_ok=True)
     print("-> Directories are set up.")
 
-def main():
+@functools.lru_cache(maxsize=1)
+def _archive_on_same_filesystem():
+    """Checks once whether the reading and archive folders live on the same filesystem."""
+    return os.stat(PAPERS_TO_READ_DIR).st_dev == os.stat(READ_PAPERS_DIR).st_dev
+
+def archive_paper(pdf_file):
+    """
+    Moves a processed paper from the reading folder to the archive folder.
+    On the same filesystem this is a single rename; otherwise the file has
+    to be copied, which shutil.move takes care of.
+    """
+    pdf_path = os.path.join(PAPERS_TO_READ_DIR, pdf_file)
+    destination_path = os.path.join(READ_PAPERS_DIR, pdf_file)
+    if _archive_on_same_filesystem():
+        os.replace(pdf_path, destination_path)
+    else:
+        shutil.move(pdf_path, destination_path)
+
+async def upload_reference_manual(manual_path):
+    """
+    Returns the uploaded reference manual, reusing the copy uploaded by an
+    earlier run if the manual's content is unchanged and the copy is still
+    active on the service. Otherwise uploads it and records the new copy in
+    ASSETS_CACHE_FILE under the manual's SHA-256 digest.
+    """
+    with open(manual_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+
+    try:
+        with open(ASSETS_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cached = json.load(f).get(digest)
+    except (OSError, ValueError, AttributeError):
+        cached = None
+
+    if cached:
+        try:
+            manual_file = await client.aio.files.get(name=cached['name'])
+            still_valid = manual_file.expiration_time is None or \
+                manual_file.expiration_time - datetime.now(timezone.utc) > REFERENCE_MIN_LIFETIME
+            if manual_file.state and manual_file.state.name == 'ACTIVE' and still_valid:
+                print(f"  - Reusing previously uploaded reference manual. File URI: {manual_file.uri}")
+                return manual_file
+        except Exception:
+            pass  # Expired or deleted, upload it again
+
+    print("  - Uploading reference manual to Gemini...")
+    manual_file = await client.aio.files.upload(file=manual_path, config={'display_name': os.path.basename(manual_path)})
+    print(f"  - Upload successful! File URI: {manual_file.uri}")
+
+    try:
+        with open(ASSETS_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({digest: {
+                'name': manual_file.name,
+                'uri': manual_file.uri,
+                'uploaded_at': datetime.now(timezone.utc).isoformat(),
+            }}, f, indent=2)
+    except OSError as e:
+        print(f"  - WARNING: Could not write assets cache '{ASSETS_CACHE_FILE}'. Details: {e}")
+    return manual_file
+
+def hash_paper(pdf_path):
+    """Returns the SHA-256 digest of a paper's content, read through a memory map."""
+    with open(pdf_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()  # Empty files cannot be memory-mapped
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return hashlib.sha256(content).hexdigest()
+
+def read_papers(pdf_paths):
+    """
+    Reads the given papers into memory. On Linux with the optional liburing
+    package installed, all reads are submitted to the kernel at once through
+    io_uring. Otherwise, or if io_uring is disabled, they are read one by one.
+    """
+    if liburing is not None:
+        try:
+            return _read_with_io_uring(pdf_paths)
+        except OSError:
+            pass  # io_uring is unavailable here, read the files normally
+    contents = []
+    for pdf_path in pdf_paths:
+        with open(pdf_path, 'rb') as f:
+            contents.append(f.read())
+    return contents
+
+def _read_with_io_uring(pdf_paths):
+    """Reads whole files with a single io_uring submission, see read_papers."""
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    fds = []
+    buffers = []
+    lengths = {}
+    liburing.io_uring_queue_init(max(len(pdf_paths), 1), ring)
+    try:
+        for index, pdf_path in enumerate(pdf_paths):
+            fd = os.open(pdf_path, os.O_RDONLY)
+            fds.append(fd)
+            buffers.append(bytearray(os.fstat(fd).st_size))
+            if not buffers[-1]:
+                lengths[index] = 0  # Nothing to read
+                continue
+            sqe = liburing.io_uring_get_sqe(ring)
+            liburing.io_uring_prep_read(sqe, fd, buffers[-1], 0)
+            liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_ASYNC)
+            sqe.user_data = index
+        liburing.io_uring_submit_and_wait(ring, len(pdf_paths) - len(lengths))
+
+        while len(lengths) < len(pdf_paths):
+            liburing.io_uring_wait_cqe(ring, cqe)
+            ready = liburing.io_uring_cq_ready(ring)
+            for i in range(ready):
+                entry = cqe[i]
+                if entry.res < 0:
+                    raise OSError(-entry.res, os.strerror(-entry.res), pdf_paths[entry.user_data])
+                lengths[entry.user_data] = entry.res
+            liburing.io_uring_cq_advance(ring, ready)
+
+        # A read may return less than requested, fetch any remainder normally
+        for index, buffer in enumerate(buffers):
+            while lengths[index] < len(buffer):
+                chunk = os.pread(fds[index], len(buffer) - lengths[index], lengths[index])
+                if not chunk:
+                    raise OSError(f"Unexpected end of file: {pdf_paths[index]}")
+                buffer[lengths[index]:lengths[index] + len(chunk)] = chunk
+                lengths[index] += len(chunk)
+    finally:
+        liburing.io_uring_queue_exit(ring)
+        for fd in fds:
+            os.close(fd)
+    # Convert one buffer at a time, so at most one paper is held twice
+    contents = []
+    buffers.reverse()
+    while buffers:
+        contents.append(bytes(buffers.pop()))
+    return contents
+
+def load_processed_index():
+    """Returns the digest to citekey mapping of all papers summarized so far."""
+    try:
+        with open(PROCESSED_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"  - WARNING: Could not read '{PROCESSED_INDEX_FILE}'. Details: {e}. Starting a new index.")
+        return {}
+
+def record_processed(processed, digest, citekey):
+    """Adds a summarized paper to the index and saves it, replacing the file atomically."""
+    processed[digest] = citekey
+    tmp_path = PROCESSED_INDEX_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(processed, f, indent=2)
+    os.replace(tmp_path, PROCESSED_INDEX_FILE)
+
+async def find_new_papers(pdf_files, processed, pdf_citekey_map):
+    """
+    Finds the papers that still need a summary.
+
+    Papers already in the processed index are archived straight away. When
+    the same paper is present more than once, only one copy is summarized,
+    preferably one whose filename has a citekey in `pdf_citekey_map`; the
+    others are returned separately, see archive_duplicates.
+
+    Returns:
+        tuple: A {filename: digest} mapping of the papers to summarize, and
+        one of their duplicates.
+    """
+    new_papers = {}
+    duplicates = {}
+    pending = {}
+    for pdf_file in pdf_files:
+        try:
+            digest = await asyncio.to_thread(hash_paper, os.path.join(PAPERS_TO_READ_DIR, pdf_file))
+        except OSError as e:
+            print(f"\n  - ERROR: Could not read {pdf_file}: {e}")
+            print("  - Skipping this file.")
+            continue
+        if digest in processed:
+            print(f"  - [{pdf_file}] Already summarized as '{processed[digest]}'. Archiving without summarizing.")
+            try:
+                await asyncio.to_thread(archive_paper, pdf_file)
+            except OSError as e:
+                print(f"  - WARNING: Could not archive '{pdf_file}'. Details: {e}")
+        elif digest in pending:
+            kept = pending[digest]
+            if pdf_citekey_map.get(kept) is None and pdf_citekey_map.get(pdf_file) is not None:
+                # Summarize the copy the bibliography knows about instead
+                del new_papers[kept]
+                pending[digest] = pdf_file
+                new_papers[pdf_file] = digest
+                kept, pdf_file = pdf_file, kept
+            print(f"  - [{pdf_file}] Same content as '{kept}'. Archiving it once that copy is summarized.")
+            duplicates[pdf_file] = digest
+        else:
+            pending[digest] = pdf_file
+            new_papers[pdf_file] = digest
+    return new_papers, duplicates
+
+async def archive_duplicates(duplicates, processed):
+    """Archives the duplicate papers whose content was summarized in this run."""
+    for pdf_file, digest in duplicates.items():
+        if digest not in processed:
+            continue  # The kept copy failed, so try again next run
+        try:
+            await asyncio.to_thread(archive_paper, pdf_file)
+            print(f"  - [{pdf_file}] Moved duplicate of '{processed[digest]}' to '{READ_PAPERS_DIR}'.")
+        except OSError as e:
+            print(f"  - WARNING: Could not archive '{pdf_file}'. Details: {e}")
+
+class CitekeyTrie:
+    """Looks up citekeys in a marisa-trie BytesTrie with the same .get() as a dict."""
+
+    def __init__(self, pdf_citekey_map):
+        self._trie = marisa_trie.BytesTrie((pdf_file, citekey.encode('utf-8')) for pdf_file, citekey in pdf_citekey_map.items())
+
+    def get(self, pdf_file, default=None):
+        values = self._trie.get(pdf_file)  # A BytesTrie returns every value stored for the key
+        return values[0].decode('utf-8') if values else default
+
+def build_citekey_index(pdf_citekey_map):
+    """
+    Returns the object used to look up citekeys by filename: the mapping
+    itself, or a CitekeyTrie for large bibliographies when the optional
+    marisa-trie package is installed. Both are read with .get().
+    """
+    if marisa_trie is None or len(pdf_citekey_map) < CITEKEY_TRIE_THRESHOLD:
+        return pdf_citekey_map
+    return CitekeyTrie(pdf_citekey_map)
+
+def resolve_citekey(pdf_file, pdf_citekey_map):
+    """Returns the citekey for a paper, falling back to its filename."""
+    citekey = pdf_citekey_map.get(pdf_file)
+    if citekey is None:
+        citekey = os.path.splitext(pdf_file)[0]
+        print(f"  - [{pdf_file}] WARNING: Could not find citekey in '{BIBTEX_FILE_PATH}'. Using '{citekey}' as fallback.")
+    else:
+        print(f"  - [{pdf_file}] Found citekey: '{citekey}'")
+    return citekey
+
+def summary_header(citekey):
+    """The heading written above each summary, using section* for un-numbered sections."""
+    return f"\\section*{{{citekey}}}\n\n"
+
+# Written after each summary for clarity
+SUMMARY_SEPARATOR = "\n\n---\n\n"
+
+def format_summary(citekey, summary_text):
+    """Formats a summary as it is appended to the summaries file."""
+    return summary_header(citekey) + summary_text + SUMMARY_SEPARATOR
+
+async def _delete_uploaded_file(uploaded_file):
+    """Deletes an uploaded file from the service, only warning if that fails."""
+    try:
+        await client.aio.files.delete(name=uploaded_file.name)
+    except Exception as e:
+        print(f"  - WARNING: Could not delete {uploaded_file.name}. Details: {e}")
+
+def delete_in_background(uploaded_file):
+    """
+    Starts deleting an uploaded file without waiting for it, since the next
+    paper does not depend on it. See wait_for_background_deletes.
+    """
+    task = asyncio.create_task(_delete_uploaded_file(uploaded_file))
+    _background_deletes.add(task)
+    task.add_done_callback(_background_deletes.discard)
+
+async def wait_for_background_deletes():
+    """Gives pending deletions up to DELETE_WAIT_TIMEOUT seconds to finish."""
+    if _background_deletes:
+        print("\n  - Waiting for uploaded files to be deleted from service...")
+        await asyncio.wait(_background_deletes, timeout=DELETE_WAIT_TIMEOUT)
+
+async def sync_to_disk(f):
+    """
+    Flushes a file opened with aiofiles and syncs it to disk, so that a crash
+    can lose at most the summary that was being written.
+    """
+    await f.flush()
+    await asyncio.to_thread(os.fsync, f.fileno())
+
+def _is_rate_limit_error(error):
+    """Checks whether an error is the API rejecting a request for exceeding the quota."""
+    return isinstance(error, errors.APIError) and error.code == 429
+
+def _retry_delay_from_error(error):
+    """
+    Returns the retry delay in seconds suggested by a 429 error, or None.
+    The API reports it as a RetryInfo detail, e.g. {'retryDelay': '37s'}.
+    """
+    try:
+        details = error.details['error']['details']
+    except (AttributeError, KeyError, TypeError):
+        return None
+    for detail in details:
+        match = re.fullmatch(r'([\d.]+)s', str(detail.get('retryDelay', '')))
+        if match:
+            return float(match.group(1))
+    return None
+
+_exponential_backoff = wait_exponential_jitter(initial=1, max=60)
+
+def _wait_before_retry(retry_state):
+    """Waits as long as the API asks for, or backs off exponentially if it does not say."""
+    delay = _retry_delay_from_error(retry_state.outcome.exception())
+    if delay is None:
+        return _exponential_backoff(retry_state)
+    return delay + random.uniform(0, RETRY_JITTER)
+
+def _log_retry(retry_state):
+    """Reports a rate-limited request before waiting to retry it."""
+    print(f"  - Rate limit reached. Retrying in {retry_state.next_action.sleep:.0f}s "
+          f"(retry {retry_state.attempt_number} of {MAX_RETRIES})...")
+
+@retry(
+    retry=retry_if_exception(_is_rate_limit_error),
+    wait=_wait_before_retry,
+    stop=stop_after_attempt(MAX_RETRIES + 1),  # The first attempt plus MAX_RETRIES retries
+    before_sleep=_log_retry,
+    reraise=True,
+)
+async def _generate_within_limits(prompt_parts, token_count, output_path, generation_config):
+    """
+    Reserves one request and `token_count` tokens of the budget, then streams
+    the model's response into `output_path` as it arrives.
+    """
+    await request_limiter.acquire()
+    await token_limiter.acquire(token_count)
+    stream = await client.aio.models.generate_content_stream(model=MODEL, contents=prompt_parts, config=generation_config)
+    received_text = False
+    async with aiofiles.open(output_path, 'w', encoding='utf-8') as f:
+        async for chunk in stream:
+            if chunk.text:
+                await f.write(chunk.text)
+                await f.flush()
+                received_text = True
+    if not received_text:
+        raise ValueError("The model returned an empty response.")
+
+async def generate_summary(prompt_parts, output_path, generation_config, cached_tokens=0):
+    """
+    Streams a summary into `output_path` without exceeding the configured
+    rate limits. `cached_tokens` is the size of the cached content used by
+    `generation_config`, which counts towards the quota but not towards
+    count_tokens on `prompt_parts`.
+    """
+    token_count = await client.aio.models.count_tokens(model=MODEL, contents=prompt_parts)
+    # A single request can never reserve more than the whole per-minute budget
+    request_tokens = min(token_count.total_tokens + cached_tokens, TOKENS_PER_MINUTE)
+    await _generate_within_limits(prompt_parts, request_tokens, output_path, generation_config)
+
+async def create_prompt_cache(master_prompt, siunitx_manual_file):
+    """
+    Stores the master prompt and reference manual as Gemini cached content,
+    so they are sent once instead of with every paper. Returns None if the
+    prompt cannot be cached, e.g. because it is shorter than the minimum
+    size the API accepts for caching.
+    """
+    contents = [master_prompt]
+    if siunitx_manual_file:
+        contents.append(siunitx_manual_file)
+    try:
+        cache = await client.aio.caches.create(
+            model=MODEL,
+            config=types.CreateCachedContentConfig(contents=contents, ttl=PROMPT_CACHE_TTL, display_name='lit-review-master-prompt'),
+        )
+    except Exception as e:
+        print(f"\nINFO: Could not cache the master prompt. Details: {e}. Sending it with every paper instead.")
+        return None
+    print(f"\n-> Cached the master prompt as '{cache.name}'.")
+    return cache
+
+async def pack_by_tokens(uploaded_papers, prompt_tokens):
+    """
+    Splits uploaded papers into groups, keeping their order, so that each
+    group plus the `prompt_tokens` of the master prompt stays within
+    MAX_GROUP_TOKENS and TOKENS_PER_MINUTE. A paper that does not fit with
+    any other ends up in a group by itself.
+    """
+    max_tokens = min(MAX_GROUP_TOKENS, TOKENS_PER_MINUTE) - prompt_tokens
+    groups = [[]]
+    group_tokens = 0
+    for paper in uploaded_papers:
+        token_count = await client.aio.models.count_tokens(model=MODEL, contents=[paper[2]])
+        if groups[-1] and group_tokens + token_count.total_tokens > max_tokens:
+            groups.append([])
+            group_tokens = 0
+        groups[-1].append(paper)
+        group_tokens += token_count.total_tokens
+    return groups
+
+def remove_partial_summary(partial_path):
+    """Removes a file from SUMMARIES_IN_PROGRESS_DIR, if it was created at all."""
+    try:
+        os.remove(partial_path)
+    except FileNotFoundError:
+        pass
+
+async def generate_group_summaries(group, prompt_prefix, generation_config, cached_tokens=0):
+    """
+    Summarizes several uploaded papers with a single request, asking for a
+    JSON list with one {filename, summary} object per paper. Each summary is
+    written to the paper's file in SUMMARIES_IN_PROGRESS_DIR.
+
+    Returns:
+        set: The filenames of the papers that received a summary.
+    """
+    prompt_parts = [*prompt_prefix, GROUP_INSTRUCTIONS.format(count=len(group))]
+    for pdf_file, _, uploaded_file in group:
+        prompt_parts += [f"Filename: {pdf_file}", uploaded_file]
+    group_config = generation_config.model_copy(update={
+        'response_mime_type': 'application/json',
+        'response_schema': GROUP_RESPONSE_SCHEMA,
+    })
+
+    group_path = os.path.join(SUMMARIES_IN_PROGRESS_DIR, f"{group[0][0]}.group.json")
+    try:
+        await generate_summary(prompt_parts, group_path, group_config, cached_tokens)
+        with open(group_path, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+    finally:
+        remove_partial_summary(group_path)
+
+    filenames = {pdf_file for pdf_file, _, _ in group}
+    summarized = set()
+    for result in results:
+        pdf_file = result.get('filename')
+        if pdf_file in filenames and result.get('summary'):
+            with open(os.path.join(SUMMARIES_IN_PROGRESS_DIR, f"{pdf_file}.txt"), 'w', encoding='utf-8') as f:
+                f.write(result['summary'])
+            summarized.add(pdf_file)
+    return summarized
+
+async def keep_prompt_cache_alive(prompt_cache):
+    """
+    Extends the cached prompt's TTL every PROMPT_CACHE_REFRESH_INTERVAL
+    seconds, so it cannot expire during a long run. Runs until cancelled.
+    """
+    while True:
+        await asyncio.sleep(PROMPT_CACHE_REFRESH_INTERVAL)
+        try:
+            await client.aio.caches.update(name=prompt_cache.name, config=types.UpdateCachedContentConfig(ttl=PROMPT_CACHE_TTL))
+        except Exception as e:
+            print(f"  - WARNING: Could not extend the cached master prompt. Details: {e}")
+
+async def process_papers(papers, pipeline_sem, generate_sem, summaries_file, write_lock, prompt_prefix, prompt_tokens, generation_config, pdf_citekey_map, processed):
+    """
+    Uploads, summarizes and archives a group of papers.
+
+    `papers` maps each paper's filename to its content digest. A single
+    paper is summarized on its own. Several papers are summarized together,
+    in as few requests as fit next to the `prompt_tokens` of the master
+    prompt, see pack_by_tokens. The papers are appended to `prompt_prefix`,
+    which is empty when the master prompt is already part of the cached
+    content in `generation_config`.
+
+    Runs under `pipeline_sem` so that at most MAX_CONCURRENCY + UPLOAD_AHEAD
+    groups are in flight, and only generates under `generate_sem`, so that
+    papers can be uploaded while MAX_CONCURRENCY requests are generating.
+    Each summary is streamed into its own file in SUMMARIES_IN_PROGRESS_DIR,
+    then appended to `summaries_file` under `write_lock` so that summaries
+    from concurrent papers never interleave. The paper's digest is then
+    recorded in the `processed` index.
+    """
+    # A cached master prompt is not part of the counted prompt, so add it to every request
+    cached_tokens = 0 if prompt_prefix else prompt_tokens
+
+    async with pipeline_sem:
+        # 1. Read the papers and upload them to the Gemini API
+        try:
+            paper_contents = await asyncio.to_thread(read_papers, [os.path.join(PAPERS_TO_READ_DIR, pdf_file) for pdf_file in papers])
+        except OSError as e:
+            print(f"\n  - ERROR: Could not read {', '.join(papers)}: {e}")
+            print("  - Skipping these files.")
+            return
+
+        uploaded_papers = []
+        for pdf_file, content in zip(papers, paper_contents):
+            print(f"\n--- Processing: {pdf_file} ---")
+            citekey = resolve_citekey(pdf_file, pdf_citekey_map)
+            try:
+                print(f"  - [{citekey}] Uploading paper to Gemini...")
+                mime_type = mimetypes.guess_type(pdf_file)[0] or 'application/pdf'
+                uploaded_file = await client.aio.files.upload(file=io.BytesIO(content), config={'display_name': pdf_file, 'mime_type': mime_type})
+                print(f"  - [{citekey}] Upload successful! File URI: {uploaded_file.uri}")
+                uploaded_papers.append((pdf_file, citekey, uploaded_file))
+            except Exception as e:
+                print(f"\n  - ERROR: An error occurred while uploading {pdf_file}: {e}")
+                print("  - Skipping this file.")
+        paper_contents = content = None  # Uploaded, no need to hold the papers while generating
+
+        if len(uploaded_papers) > 1:
+            try:
+                groups = await pack_by_tokens(uploaded_papers, prompt_tokens)
+            except Exception as e:
+                print(f"\n  - WARNING: Could not count the tokens of the group. Details: {e}. Summarizing each paper on its own.")
+                groups = [[paper] for paper in uploaded_papers]
+        else:
+            groups = [uploaded_papers] if uploaded_papers else []
+
+        for group in groups:
+            # 2. Construct the prompt and generate content
+            try:
+                async with generate_sem:
+                    if len(group) == 1:
+                        pdf_file, citekey, uploaded_file = group[0]
+                        print(f"  - [{citekey}] Generating summary...")
+                        partial_path = os.path.join(SUMMARIES_IN_PROGRESS_DIR, f"{pdf_file}.txt")
+                        await generate_summary([*prompt_prefix, uploaded_file], partial_path, generation_config, cached_tokens)
+                        summarized = {pdf_file}
+                    else:
+                        print(f"  - Generating summaries for {len(group)} papers in one request: {', '.join(citekey for _, citekey, _ in group)}...")
+                        summarized = await generate_group_summaries(group, prompt_prefix, generation_config, cached_tokens)
+            except Exception as e:
+                for pdf_file, _, _ in group:
+                    remove_partial_summary(os.path.join(SUMMARIES_IN_PROGRESS_DIR, f"{pdf_file}.txt"))
+                    print(f"\n  - ERROR: An error occurred while processing {pdf_file}: {e}")
+                    print("  - Skipping this file.")
+                continue
+
+            for pdf_file, citekey, uploaded_file in group:
+                partial_path = os.path.join(SUMMARIES_IN_PROGRESS_DIR, f"{pdf_file}.txt")
+                if pdf_file not in summarized:
+                    remove_partial_summary(partial_path)
+                    print(f"\n  - ERROR: The response contained no summary for {pdf_file}.")
+                    print("  - Skipping this file.")
+                    continue
+                try:
+                    # 3. Append the summary to the output file
+                    print(f"  - [{citekey}] Saving summary...")
+                    async with write_lock:
+                        await summaries_file.write(summary_header(citekey))
+                        async with aiofiles.open(partial_path, 'r', encoding='utf-8') as partial:
+                            while chunk := await partial.read(65536):
+                                await summaries_file.write(chunk)
+                        await summaries_file.write(SUMMARY_SEPARATOR)
+                        await sync_to_disk(summaries_file)
+                        record_processed(processed, papers[pdf_file], citekey)
+                    os.remove(partial_path)
+
+                    print(f"  - [{citekey}] Summary appended to '{SUMMARIES_FILE}'.")
+
+                    # 4. Move the processed PDF to the archive directory
+                    print(f"  - [{citekey}] Archiving processed file...")
+                    await asyncio.to_thread(archive_paper, pdf_file)
+                    print(f"  - [{citekey}] Moved '{pdf_file}' to '{READ_PAPERS_DIR}'.")
+
+                    # 5. Clean up the uploaded paper from the API service
+                    print(f"  - [{citekey}] Deleting uploaded paper from service...")
+                    delete_in_background(uploaded_file)
+
+                except Exception as e:
+                    remove_partial_summary(partial_path)
+                    print(f"\n  - ERROR: An error occurred while processing {pdf_file}: {e}")
+                    print("  - Skipping this file.")
+
+async def run_batch_job(paper_digests, master_prompt, siunitx_manual_file, pdf_citekey_map, summaries_file, processed):
+    """
+    Summarizes all papers with a single Gemini Batch job.
+
+    Every paper is uploaded first and referenced from one line of a JSONL
+    request file, keyed by its filename. Once the job has finished, each
+    response is saved under the paper's citekey and the paper is archived.
+    Papers whose request failed are left in the reading folder.
+    `paper_digests` maps each paper's filename to its content digest, which
+    is recorded in the `processed` index once the summary is saved.
+    """
+    # 1. Upload the papers and build one request per paper
+    print("\n--- Preparing Batch Job ---")
+    uploaded_files = {}
+    requests = []
+    for pdf_file in paper_digests:
+        try:
+            print(f"  - [{pdf_file}] Uploading paper to Gemini...")
+            uploaded_file = await client.aio.files.upload(file=os.path.join(PAPERS_TO_READ_DIR, pdf_file), config={'display_name': pdf_file})
+        except Exception as e:
+            print(f"  - ERROR: Could not upload {pdf_file}: {e}. Skipping this file.")
+            continue
+        uploaded_files[pdf_file] = uploaded_file
+
+        parts = [{'text': master_prompt}]
+        if siunitx_manual_file:
+            parts.append({'file_data': {'file_uri': siunitx_manual_file.uri, 'mime_type': siunitx_manual_file.mime_type}})
+        parts.append({'file_data': {'file_uri': uploaded_file.uri, 'mime_type': uploaded_file.mime_type}})
+        requests.append({'key': pdf_file, 'request': {'contents': [{'role': 'user', 'parts': parts}]}})
+
+    if not requests:
+        print("\nNo papers could be uploaded. Nothing to submit.")
+        return
+
+    # 2. Upload the request file and create the batch job
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        requests_path = os.path.join(tmp_dir, 'batch_requests.jsonl')
+        with open(requests_path, 'w', encoding='utf-8') as f:
+            for request in requests:
+                f.write(json.dumps(request) + "\n")
+        requests_file = await client.aio.files.upload(file=requests_path, config={'display_name': 'lit-review-batch-requests', 'mime_type': 'jsonl'})
+
+    batch_job = await client.aio.batches.create(model=MODEL, src=requests_file.name, config={'display_name': 'lit-review-batch'})
+    print(f"  - Submitted batch job '{batch_job.name}' with {len(requests)} paper(s).")
+
+    # 3. Wait for the job to finish
+    while batch_job.state.name not in BATCH_FINAL_STATES:
+        print(f"  - Batch job state: {batch_job.state.name}. Checking again in {BATCH_POLL_INTERVAL}s...")
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch_job = await client.aio.batches.get(name=batch_job.name)
+    print(f"  - Batch job finished with state: {batch_job.state.name}")
+
+    # 4. Save each summary and archive its paper
+    results = []
+    if batch_job.dest and batch_job.dest.file_name:
+        results_bytes = await client.aio.files.download(file=batch_job.dest.file_name)
+        results = [json.loads(line) for line in results_bytes.decode('utf-8').splitlines() if line.strip()]
+    else:
+        print(f"\nERROR: The batch job returned no results. Details: {batch_job.error}")
+
+    for result in results:
+        pdf_file = result.get('key')
+        if pdf_file not in uploaded_files:
+            continue
+        if 'response' not in result:
+            print(f"\n  - ERROR: The batch request for {pdf_file} failed: {result.get('error')}")
+            continue
+
+        citekey = resolve_citekey(pdf_file, pdf_citekey_map)
+        try:
+            response = types.GenerateContentResponse.model_validate(result['response'])
+            if not response.text:
+                raise ValueError("The model returned an empty response.")
+            print(f"  - [{citekey}] Saving summary...")
+            await summaries_file.write(format_summary(citekey, response.text))
+            await sync_to_disk(summaries_file)
+            record_processed(processed, paper_digests[pdf_file], citekey)
+
+            await asyncio.to_thread(archive_paper, pdf_file)
+            print(f"  - [{citekey}] Moved '{pdf_file}' to '{READ_PAPERS_DIR}'.")
+        except Exception as e:
+            print(f"\n  - ERROR: An error occurred while processing {pdf_file}: {e}")
+            print("  - Skipping this file.")
+
+    # 5. Clean up the uploaded files from the API service
+    print("  - Deleting uploaded papers from service...")
+    for uploaded_file in [requests_file, *uploaded_files.values()]:
+        delete_in_background(uploaded_file)
+
+async def main():
     """Main function to run the PDF processing pipeline."""
+    _configure_api()
     print("--- Integrated BibTeX and Gemini Pipeline Initialized ---")
 
     setup_directories()
 
     # --- Load Master Prompt ---
     try:
-        with open(MASTER_PROMPT_FILE, 'r', encoding='utf-8') as f:
-            master_prompt = f.read()
+        master_prompt = load_master_prompt()
         print(f"-> Successfully loaded master prompt from '{MASTER_PROMPT_FILE}'.")
     except FileNotFoundError:
         print(f"\nERROR: Master prompt file not found at '{MASTER_PROMPT_FILE}'.")
@@ -125,9 +985,7 @@ def main():
 
     # --- Load BibTeX file and create the lookup map ---
     try:
-        with open(BIBTEX_FILE_PATH, 'r', encoding='utf-8') as bibfile:
-            bib_database = bibtexparser.load(bibfile)
-        pdf_citekey_map = create_pdf_to_citekey_map(bib_database)
+        pdf_citekey_map = load_pdf_to_citekey_map(BIBTEX_FILE_PATH)
     except FileNotFoundError:
         print(f"\nERROR: BibTeX file not found at '{BIBTEX_FILE_PATH}'.")
         print("Please place your .bib file in the root directory and update the path in the script. Exiting.")
@@ -140,9 +998,8 @@ def main():
     siunitx_manual_file = None
     try:
         if os.path.exists(SIUNITX_MANUAL):
-            print("\n  - Uploading reference manual to Gemini...")
-            siunitx_manual_file = genai.upload_file(path=SIUNITX_MANUAL, display_name=os.path.basename(SIUNITX_MANUAL))
-            print(f"  - Upload successful! File URI: {siunitx_manual_file.uri}")
+            print()
+            siunitx_manual_file = await upload_reference_manual(SIUNITX_MANUAL)
         else:
             print(f"\nINFO: Optional reference manual '{SIUNITX_MANUAL}' not found. Proceeding without it.")
     except Exception as e:
@@ -151,7 +1008,8 @@ def main():
 
     # --- Find PDFs to Process ---
     try:
-        pdf_files = [f for f in os.listdir(PAPERS_TO_READ_DIR) if f.lower().endswith(('.pdf', '.html'))]
+        with os.scandir(PAPERS_TO_READ_DIR) as entries:
+            pdf_files = [entry.name for entry in entries if entry.is_file() and _PAPER_FILENAME_RE.search(entry.name)]
     except FileNotFoundError:
         print(f"\nERROR: The directory '{PAPERS_TO_READ_DIR}' does not exist. Exiting.")
         return
@@ -162,68 +1020,74 @@ def main():
         
     print(f"\nFound {len(pdf_files)} file(s) to process: {', '.join(pdf_files)}")
 
-    # --- Initialize the Model ---
-    model = genai.GenerativeModel(MODEL)
-
-    # --- Process Each PDF ---
-    for pdf_file in pdf_files:
-        pdf_path = os.path.join(PAPERS_TO_READ_DIR, pdf_file)
-        print(f"\n--- Processing: {pdf_file} ---")
+    # --- Skip Papers That Were Already Summarized ---
+    processed = load_processed_index()
+    paper_digests, duplicates = await find_new_papers(pdf_files, processed, pdf_citekey_map)
+    if not paper_digests:
+        print("\nAll papers have been summarized before. Exiting.")
+        return
 
-        citekey = pdf_citekey_map.get(pdf_file, os.path.splitext(pdf_file)[0])
-        if citekey == os.path.splitext(pdf_file)[0]:
-            print(f"  - WARNING: Could not find citekey for '{pdf_file}' in '{BIBTEX_FILE_PATH}'. Using filename as fallback.")
+    # --- Keep the Summaries File Open for the Whole Run ---
+    summaries_file = await aiofiles.open(SUMMARIES_FILE, 'a', buffering=65536, encoding='utf-8')
+    try:
+        if USE_BATCH_MODE:
+            # --- Process the PDFs as a Single Batch Job ---
+            await run_batch_job(paper_digests, master_prompt, siunitx_manual_file, pdf_citekey_map, summaries_file, processed)
         else:
-             print(f"  - Found citekey: '{citekey}'")
+            # --- Cache the Shared Part of the Prompt ---
+            prompt_cache = await create_prompt_cache(master_prompt, siunitx_manual_file)
+            if prompt_cache:
+                prompt_prefix = []
+                generation_config = GENERATION_CONFIG.model_copy(update={'cached_content': prompt_cache.name})
+            else:
+                prompt_prefix = [master_prompt]
+                if siunitx_manual_file:
+                    prompt_prefix.append(siunitx_manual_file)
+                generation_config = GENERATION_CONFIG
 
-        try:
-            # 1. Upload the main paper to the Gemini API
-            print("  - Uploading paper to Gemini...")
-            uploaded_file = genai.upload_file(path=pdf_path, display_name=pdf_file)
-            print(f"  - Upload successful! File URI: {uploaded_file.uri}")
+            # Size of the master prompt, which every request's token budget must include
+            prompt_tokens = 0
+            if prompt_cache:
+                prompt_tokens = (prompt_cache.usage_metadata and prompt_cache.usage_metadata.total_token_count) or 0
+            elif PAPERS_PER_REQUEST > 1:
+                try:
+                    prompt_tokens = (await client.aio.models.count_tokens(model=MODEL, contents=prompt_prefix)).total_tokens
+                except Exception as e:
+                    print(f"  - WARNING: Could not count the tokens of the master prompt. Details: {e}")
 
-            # 2. Construct the prompt and generate content
-            print("  - Generating summary...")
-            prompt_parts = [master_prompt]
-            if siunitx_manual_file:
-                prompt_parts.append(siunitx_manual_file)
-            prompt_parts.append(uploaded_file)
-            
-            response = model.generate_content(prompt_parts, request_options={'timeout': 600})
-
-            # 3. Append the summary to the output file
-            print("  - Saving summary...")
-            with open(SUMMARIES_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"\\section*{{{citekey}}}\n\n") # Using section* for un-numbered sections
-                f.write(response.text)
-                f.write("\n\n---\n\n") # Separator for clarity
-            
-            print(f"  - Summary for '{citekey}' appended to '{SUMMARIES_FILE}'.")
-
-            # 4. Move the processed PDF to the archive directory
-            print("  - Archiving processed file...")
-            destination_path = os.path.join(READ_PAPERS_DIR, pdf_file)
-            shutil.move(pdf_path, destination_path)
-            print(f"  - Moved '{pdf_file}' to '{READ_PAPERS_DIR}'.")
-
-            # 5. Clean up the uploaded paper from the API service
-            print("  - Deleting uploaded paper from service...")
-            genai.delete_file(uploaded_file.name)
+            # --- Process the PDFs Concurrently ---
+            pipeline_sem = asyncio.Semaphore(MAX_CONCURRENCY + UPLOAD_AHEAD)
+            generate_sem = asyncio.Semaphore(MAX_CONCURRENCY)
+            write_lock = asyncio.Lock()
+            papers = list(paper_digests.items())
+            groups = [dict(papers[i:i + PAPERS_PER_REQUEST]) for i in range(0, len(papers), PAPERS_PER_REQUEST)]
+            tasks = [
+                process_papers(group, pipeline_sem, generate_sem, summaries_file, write_lock, prompt_prefix, prompt_tokens, generation_config, pdf_citekey_map, processed)
+                for group in groups
+            ]
+            refresh_task = asyncio.create_task(keep_prompt_cache_alive(prompt_cache)) if prompt_cache else None
+            try:
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                for group, result in zip(groups, results):
+                    if isinstance(result, Exception):
+                        print(f"\n  - ERROR: An unexpected error occurred while processing {', '.join(group)}: {result}")
+                        print("  - Skipping these files.")
+            finally:
+                if refresh_task:
+                    refresh_task.cancel()
+                if prompt_cache:
+                    print("\n  - Deleting cached master prompt from service...")
+                    await client.aio.caches.delete(name=prompt_cache.name)
+    finally:
+        await summaries_file.close()
+        await wait_for_background_deletes()
 
-        except Exception as e:
-            print(f"\n  - ERROR: An error occurred while processing {pdf_file}: {e}")
-            print("  - Skipping this file and moving to the next one.")
-            continue
-        
-        # A small delay to respect API rate limits
-        time.sleep(2)
-        
-    # Clean up the reference manual at the end if it was uploaded
-    if siunitx_manual_file:
-        print("\n  - Deleting uploaded reference manual from service...")
-        genai.delete_file(siunitx_manual_file.name)
+    await archive_duplicates(duplicates, processed)
+
+    # The reference manual is kept on the service for the next run; uploaded
+    # files are deleted automatically after 48 hours.
 
     print("\n--- Pipeline Finished ---")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())